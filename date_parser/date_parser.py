@@ -1,17 +1,56 @@
 ﻿from datetime import datetime
+from functools import lru_cache
+
+
+DATE_FORMAT = "%d.%m.%Y"
+TODAY_TOKENS = frozenset(("today", "📅 today"))
+
+
+def _is_ddmmyyyy(date: str) -> bool:
+    return (
+        len(date) == 10
+        and date.isascii()
+        and date[2] == "."
+        and date[5] == "."
+        and date[:2].isdigit()
+        and date[3:5].isdigit()
+        and date[6:].isdigit()
+    )
+
+
+def _may_be_date(date: str) -> bool:
+    # strptime(DATE_FORMAT) only matches decimal digits (including non-ASCII ones), dots and spaces.
+    return all(char.isdecimal() or char in ". " for char in date)
+
+
+@lru_cache(maxsize=1024)
+def _parse_date(date: str) -> datetime:
+    if _is_ddmmyyyy(date):
+        return datetime(int(date[6:10]), int(date[3:5]), int(date[0:2]))
+    # Fall back for looser input such as "5.3.2024".
+    return datetime.strptime(date, DATE_FORMAT)
 
 
 class DateParser:
     def parse_string_to_date(self, date: str) -> datetime:
         """Convert user input to datetime."""
-        if not date:
-            raise ValueError("Date text is empty")
+        parsed = self.try_parse_string_to_date(date)
+        if parsed is None:
+            raise ValueError(f"Invalid date: {date!r}")
+        return parsed
 
-        normalized = date.strip().casefold()
-        if normalized in ("today", "📅 today"):
+    def try_parse_string_to_date(self, date: str) -> datetime | None:
+        """Convert user input to datetime, or return None if it is not a valid date."""
+        stripped = date.strip() if date else ""
+        if stripped.casefold() in TODAY_TOKENS:
             return datetime.today()
-        return datetime.strptime(date.strip(), "%d.%m.%Y")
+        if not stripped or not _may_be_date(stripped):
+            return None
+        try:
+            return _parse_date(stripped)
+        except ValueError:
+            return None
 
     def parse_date_to_string(self, date: datetime) -> str:
         """Convert datetime to dd.mm.yyyy."""
-        return date.strftime("%d.%m.%Y")
+        return f"{date.day:02d}.{date.month:02d}.{date.year:04d}"
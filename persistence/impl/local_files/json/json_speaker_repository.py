@@ -16,11 +16,15 @@ def normalize_speaker_key(name: str) -> str:
 
 
 class JsonSpeakerRepository(SpeakerRepository):
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, flush_delay: float = 1.0, max_pending_changes: int = 50):
         self.file_path = file_path
+        self.flush_delay = flush_delay
+        self.max_pending_changes = max_pending_changes
         self._lock = threading.Lock()
         self._speakers_by_chat: dict[str, list[Speaker]] = defaultdict(list)
         self._index_by_chat: dict[str, dict[str, Speaker]] = defaultdict(dict)
+        self._pending_changes = 0
+        self._flush_timer: threading.Timer | None = None
         self._load()
 
     def _chat_key(self, chat_id: int | str | None) -> str:
@@ -94,12 +98,14 @@ class JsonSpeakerRepository(SpeakerRepository):
     def _write_atomic(self) -> None:
         directory = os.path.dirname(self.file_path) or "."
         os.makedirs(directory, exist_ok=True)
-        payload = self._serialize()
+        payload = json.dumps(self._serialize(), ensure_ascii=False, indent=2).encode("utf-8")
 
         fd, temp_path = tempfile.mkstemp(prefix="speakers_", suffix=".tmp", dir=directory)
         try:
-            with os.fdopen(fd, "w", encoding="utf-8") as temp_file:
-                json.dump(payload, temp_file, ensure_ascii=False, indent=2)
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(payload)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
             os.replace(temp_path, self.file_path)
         except Exception:
             try:
@@ -108,6 +114,31 @@ class JsonSpeakerRepository(SpeakerRepository):
                 pass
             raise
 
+    def _mark_dirty(self) -> None:
+        # Called with self._lock held; bursts of changes are coalesced into one delayed write.
+        self._pending_changes += 1
+        if self.flush_delay <= 0 or self._pending_changes >= self.max_pending_changes:
+            self._flush_pending()
+            return
+
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush_pending(self) -> None:
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        if self._pending_changes:
+            self._write_atomic()
+            self._pending_changes = 0
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_pending()
+
     def get_speakers(self, chat_id: int | str | None = None) -> list[Speaker]:
         chat_key = self._chat_key(chat_id)
         with self._lock:
@@ -127,9 +158,9 @@ class JsonSpeakerRepository(SpeakerRepository):
             else:
                 new_speaker = Speaker(name=speaker.name, speaker_image_ids=cleaned_image_ids)
                 self._speakers_by_chat[chat_key].append(new_speaker)
+                self._index_by_chat[chat_key][key] = new_speaker
 
-            self._reindex_chat(chat_key)
-            self._write_atomic()
+            self._mark_dirty()
 
     def get_speaker(self, name: str, chat_id: int | str | None = None) -> Speaker | None:
         chat_key = self._chat_key(chat_id)
@@ -150,8 +181,7 @@ class JsonSpeakerRepository(SpeakerRepository):
 
             if old_key == new_key:
                 source.name = new_name
-                self._reindex_chat(chat_key)
-                self._write_atomic()
+                self._mark_dirty()
                 return source
 
             target = speakers_by_name.get(new_key)
@@ -160,11 +190,12 @@ class JsonSpeakerRepository(SpeakerRepository):
                 target.speaker_image_ids = merged_ids
                 source_list = self._speakers_by_chat[chat_key]
                 self._speakers_by_chat[chat_key] = [speaker for speaker in source_list if speaker is not source]
-                self._reindex_chat(chat_key)
-                self._write_atomic()
+                del speakers_by_name[old_key]
+                self._mark_dirty()
                 return target
 
             source.name = new_name
-            self._reindex_chat(chat_key)
-            self._write_atomic()
+            del speakers_by_name[old_key]
+            speakers_by_name[new_key] = source
+            self._mark_dirty()
             return source
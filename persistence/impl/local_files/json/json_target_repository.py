@@ -67,11 +67,14 @@ class JsonTargetRepository(TargetRepository):
     def _write_atomic(self) -> None:
         directory = os.path.dirname(self.file_path) or "."
         os.makedirs(directory, exist_ok=True)
+        payload = json.dumps(self._serialize(), ensure_ascii=False, indent=2).encode("utf-8")
 
         fd, temp_path = tempfile.mkstemp(prefix="targets_", suffix=".tmp", dir=directory)
         try:
-            with os.fdopen(fd, "w", encoding="utf-8") as temp_file:
-                json.dump(self._serialize(), temp_file, ensure_ascii=False, indent=2)
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(payload)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
             os.replace(temp_path, self.file_path)
         except Exception:
             try:
@@ -19,3 +19,7 @@ class SpeakerRepository(ABC):
     @abstractmethod
     def rename_speaker(self, old_name: str, new_name: str, chat_id: int | str | None = None) -> Speaker | None:
         raise NotImplementedError
+
+    @abstractmethod
+    def flush(self) -> None:
+        raise NotImplementedError
@@ -2,6 +2,7 @@
 import math
 from collections import Counter
 from pathlib import Path
+from typing import Callable
 
 from PIL import Image, ImageDraw, ImageFont
 
@@ -11,9 +12,19 @@ from domain.speaker import Speaker
 from quote_generator.quote_text_generator import QuoteTextGenerator
 
 
+def _opacity_lut(factor: float) -> list[int]:
+    return [round(value * factor) for value in range(256)]
+
+
+SCROLL_ALPHA_LUT = _opacity_lut(0.33)
+STICKER_BACKDROP_ALPHA_LUT = _opacity_lut(0.25)
+
+
 class QuoteImageGenerator:
     CANVAS_WIDTH = 1100
     CANVAS_HEIGHT = 512
+    # Telegram recompresses photos anyway, so favour encode speed over size.
+    PNG_COMPRESS_LEVEL = 1
 
     def __init__(self, quote_text_generator: QuoteTextGenerator, date_parser: DateParser):
         self.quote_text_generator = quote_text_generator
@@ -22,45 +33,82 @@ class QuoteImageGenerator:
         assets_dir = Path("assets")
         self._font_path_main = str(assets_dir / "SourceSans3-BoldItalic.ttf")
         self._font_path_secondary = str(assets_dir / "Gabriela-Regular.ttf")
+        self._fonts: dict[tuple[str, int], ImageFont.FreeTypeFont | ImageFont.ImageFont] = {}
+        self._default_font = ImageFont.load_default()
+        self._line_heights: dict[ImageFont.FreeTypeFont | ImageFont.ImageFont, int] = {}
 
-        self._quote_sign_img = self._safe_open_rgba(assets_dir / "quote-sign.png")
-        self._scroll_img = self._safe_open_rgba(assets_dir / "scroll.png")
-        self._base_gradient = self._create_radial_gradient(
+        self._quote_sign_img = self._as_layer(self._safe_open_rgba(assets_dir / "quote-sign.png"))
+        base_gradient = self._create_radial_gradient(
             (self.CANVAS_WIDTH, self.CANVAS_HEIGHT),
             inner_color=(44, 211, 189, 255),
             outer_color=(36, 129, 117, 255),
         )
+        # Gradient and dimmed scroll never change, so compose them once and copy per image.
+        self._background = self._create_background(base_gradient, self._safe_open_rgba(assets_dir / "scroll.png"))
 
     def _safe_open_rgba(self, path: Path) -> Image.Image:
         return Image.open(path).convert("RGBA")
 
+    def _as_layer(self, image: Image.Image) -> Image.Image:
+        # Same pixels the image ends up with when pasted through its own mask onto a transparent layer.
+        layer = Image.new("RGBA", image.size, (0, 0, 0, 0))
+        layer.paste(image, (0, 0), image)
+        return layer
+
+    def _alpha_composite_at(self, canvas: Image.Image, image: Image.Image, position: tuple[int, int]) -> None:
+        # Blend only the covered region in place; alpha_composite() rejects negative offsets, so clip them here.
+        x, y = position
+        source_x, source_y = max(0, -x), max(0, -y)
+        if source_x >= image.width or source_y >= image.height:
+            return
+        canvas.alpha_composite(image, dest=(max(0, x), max(0, y)), source=(source_x, source_y))
+
+    def _create_background(self, gradient: Image.Image, scroll_img: Image.Image) -> Image.Image:
+        scroll_img.putalpha(scroll_img.getchannel("A").point(SCROLL_ALPHA_LUT))
+
+        self._alpha_composite_at(gradient, self._as_layer(scroll_img), (self.CANVAS_WIDTH - scroll_img.width - 10, 0))
+        return gradient
+
     def _load_font(self, font_path: str, font_size: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
+        key = (font_path, font_size)
+        font = self._fonts.get(key)
+        if font is not None:
+            return font
+
         try:
-            return ImageFont.truetype(font_path, font_size)
+            font = ImageFont.truetype(font_path, font_size)
         except OSError:
-            return ImageFont.load_default()
+            font = self._default_font
+        self._fonts[key] = font
+        return font
+
+    def _line_height(self, draw: ImageDraw.ImageDraw, font: ImageFont.FreeTypeFont | ImageFont.ImageFont) -> int:
+        line_height = self._line_heights.get(font)
+        if line_height is None:
+            bbox = draw.textbbox((0, 0), "A", font=font)
+            line_height = bbox[3] - bbox[1]
+            self._line_heights[font] = line_height
+        return line_height
 
     def _create_radial_gradient(self, size: tuple[int, int], inner_color: tuple[int, int, int, int], outer_color: tuple[int, int, int, int]) -> Image.Image:
         width, height = size
         center_x, center_y = width // 2, height // 2
         max_radius = math.sqrt(center_x ** 2 + center_y ** 2)
 
-        gradient = Image.new("RGBA", (width, height), outer_color)
-        draw = ImageDraw.Draw(gradient)
-
-        for y in range(height):
-            for x in range(width):
-                dx = x - center_x
-                dy = y - center_y
-                dist = min(1, math.sqrt(dx * dx + dy * dy) / max_radius)
-
-                r = int(inner_color[0] + (outer_color[0] - inner_color[0]) * dist)
-                g = int(inner_color[1] + (outer_color[1] - inner_color[1]) * dist)
-                b = int(inner_color[2] + (outer_color[2] - inner_color[2]) * dist)
-                a = int(inner_color[3] + (outer_color[3] - inner_color[3]) * dist)
-                draw.point((x, y), (r, g, b, a))
-
-        return gradient
+        # Image.radial_gradient() is a 256x256 distance mask that reaches 255 at its corners,
+        # i.e. at radius 128 * sqrt(2). Scale it so the canvas corners land on max_radius.
+        diameter = math.ceil(max_radius * 2)
+        left = diameter // 2 - center_x
+        top = diameter // 2 - center_y
+        mask = Image.radial_gradient("L").resize((diameter, diameter), Image.Resampling.BILINEAR)
+        mask = mask.crop((left, top, left + width, top + height))
+        mask = mask.point([min(255, round(value * math.sqrt(2))) for value in range(256)])
+
+        return Image.composite(
+            Image.new("RGBA", (width, height), outer_color),
+            Image.new("RGBA", (width, height), inner_color),
+            mask,
+        )
 
     def crop_transparency(self, image: Image.Image) -> Image.Image:
         if image.mode != "RGBA":
@@ -71,22 +119,76 @@ class QuoteImageGenerator:
         return image
 
     def add_main_sticker_to_canvas(self, image_file: bytes, height: int, canvas: Image.Image) -> Image.Image:
-        sticker_img = Image.open(io.BytesIO(image_file)).convert("RGBA")
-        sticker_img = self.crop_transparency(sticker_img)
+        # crop_transparency() converts to RGBA itself, and only when the sticker is not already RGBA.
+        sticker_img = self.crop_transparency(Image.open(io.BytesIO(image_file)))
 
         zoom_factor = 1.7
         zoomed_size = (int(sticker_img.width * zoom_factor), int(sticker_img.height * zoom_factor))
-        sticker_zoomed = sticker_img.resize(zoomed_size, Image.LANCZOS).convert("LA").convert("RGBA")
+        # Grayscale and dim at source size so the zoomed copy only costs the resize itself.
+        sticker_gray = sticker_img.convert("L")
+        sticker_alpha = sticker_img.getchannel("A").point(STICKER_BACKDROP_ALPHA_LUT)
+        sticker_backdrop = Image.merge("RGBA", (sticker_gray, sticker_gray, sticker_gray, sticker_alpha))
+
+        # The zoomed copy is right-aligned to x=512 and hangs off the left and bottom edges,
+        # so only resample the part of it that lands on the canvas.
+        zoomed_width, zoomed_height = zoomed_size
+        visible_left = max(0, zoomed_width - 512)
+        visible_bottom = min(zoomed_height, canvas.height)
+        if visible_left < zoomed_width and visible_bottom > 0:
+            source_box = (
+                visible_left * sticker_img.width / zoomed_width,
+                0,
+                sticker_img.width,
+                visible_bottom * sticker_img.height / zoomed_height,
+            )
+            sticker_zoomed = sticker_backdrop.resize(
+                (zoomed_width - visible_left, visible_bottom),
+                Image.Resampling.BICUBIC,
+                box=source_box,
+            )
+            canvas.paste(sticker_zoomed, (512 - zoomed_width + visible_left, 0), sticker_zoomed)
 
-        sticker_alpha = sticker_zoomed.split()[3]
-        sticker_alpha = sticker_alpha.point(lambda pixel: pixel * 0.25)
-        sticker_zoomed.putalpha(sticker_alpha)
+        self._alpha_composite_at(canvas, self._as_layer(sticker_img), (0, height - sticker_img.height))
+        return canvas
 
-        canvas.paste(sticker_zoomed, (512 - zoomed_size[0], 0), sticker_zoomed)
+    def _wrap_words(
+        self,
+        draw: ImageDraw.ImageDraw,
+        paragraphs: list[list[str]],
+        unique_words: set[str],
+        font: ImageFont.FreeTypeFont | ImageFont.ImageFont,
+        max_width: int,
+    ) -> list[str]:
+        # Measure every word once per size; line widths are summed instead of re-measuring prefixes.
+        word_widths = {word: draw.textlength(word, font=font) for word in unique_words}
+        space_width = draw.textlength(" ", font=font)
+        lines: list[str] = []
+
+        for words in paragraphs:
+            if not words:
+                lines.append("")
+                continue
 
-        sticker_layer = Image.new("RGBA", canvas.size, (0, 0, 0, 0))
-        sticker_layer.paste(sticker_img, (0, height - sticker_img.height), sticker_img)
-        return Image.alpha_composite(canvas, sticker_layer)
+            current_line: list[str] = []
+            current_width = 0.0
+            for word in words:
+                word_width = word_widths[word]
+                line_width = current_width + space_width + word_width if current_line else word_width
+                if line_width <= max_width:
+                    current_line.append(word)
+                    current_width = line_width
+                else:
+                    if current_line:
+                        lines.append(" ".join(current_line))
+                    current_line = [word]
+                    current_width = word_width
+            if current_line:
+                lines.append(" ".join(current_line))
+            lines.append("")
+
+        if lines and lines[-1] == "":
+            lines.pop()
+        return lines
 
     def fit_text_to_box(
         self,
@@ -99,46 +201,42 @@ class QuoteImageGenerator:
         min_size: int = 20,
         line_spacing: float = 1.2,
     ) -> tuple[ImageFont.FreeTypeFont | ImageFont.ImageFont, list[str]]:
-        font_size = start_size
-        fallback_font = ImageFont.load_default()
+        fallback_font = self._default_font
         fallback_lines = [text] if text else [""]
+        paragraphs = [paragraph.split() for paragraph in text.split("\n")]
+        unique_words = {word for words in paragraphs for word in words}
 
-        while font_size >= min_size:
+        def try_size(font_size: int) -> tuple[ImageFont.FreeTypeFont | ImageFont.ImageFont, list[str]] | None:
             font = self._load_font(font_path, font_size)
-            lines: list[str] = []
-
-            for paragraph in text.split("\n"):
-                words = paragraph.split()
-                if not words:
-                    lines.append("")
-                    continue
-
-                current_line: list[str] = []
-                for word in words:
-                    test_line = " ".join(current_line + [word])
-                    line_width = draw.textlength(test_line, font=font)
-                    if line_width <= max_width:
-                        current_line.append(word)
-                    else:
-                        if current_line:
-                            lines.append(" ".join(current_line))
-                        current_line = [word]
-                if current_line:
-                    lines.append(" ".join(current_line))
-                lines.append("")
+            lines = self._wrap_words(draw, paragraphs, unique_words, font, max_width)
 
-            if lines and lines[-1] == "":
-                lines.pop()
-
-            bbox = draw.textbbox((0, 0), "A", font=font)
-            line_height = bbox[3] - bbox[1]
-            total_height = int(line_height * len(lines) * line_spacing)
+            total_height = int(self._line_height(draw, font) * len(lines) * line_spacing)
 
             if total_height <= max_height:
                 return font, lines or [""]
-            font_size -= 2
+            return None
+
+        sizes = list(range(start_size, min_size - 1, -2))
+        if not sizes:
+            return fallback_font, fallback_lines
 
-        return fallback_font, fallback_lines
+        # Most quotes fit at the start size, so check it before searching.
+        best = try_size(sizes[0])
+        if best is not None:
+            return best
+
+        # Smaller sizes only ever need fewer lines, so binary-search for the largest size that fits.
+        low, high = 1, len(sizes) - 1
+        while low <= high:
+            middle = (low + high) // 2
+            fitted = try_size(sizes[middle])
+            if fitted is not None:
+                best = fitted
+                high = middle - 1
+            else:
+                low = middle + 1
+
+        return best if best is not None else (fallback_font, fallback_lines)
 
     def _get_main_speaker(self, quote: Quote) -> Speaker | None:
         speakers = [phrase.speaker for phrase in quote.phrases if phrase.speaker]
@@ -190,6 +288,15 @@ class QuoteImageGenerator:
 
         return main_speaker.speaker_image_id
 
+    def _get_first_image_id(self, quote: Quote) -> str | None:
+        for phrase in quote.phrases:
+            if not phrase.speaker:
+                continue
+            image_id = phrase.speaker_image_id or phrase.speaker.speaker_image_id
+            if image_id:
+                return image_id
+        return None
+
     def _truncate_text_to_width(
         self,
         draw: ImageDraw.ImageDraw,
@@ -206,18 +313,8 @@ class QuoteImageGenerator:
             candidate = candidate[:-1]
         return f"{candidate}{ellipsis}" if candidate else ellipsis
 
-    def generate_quote_image(self, quote: Quote, images: dict[str, bytes]) -> io.BytesIO:
-        canvas = self._base_gradient.copy().convert("RGBA")
-
-        scroll_img = self._scroll_img.copy()
-        scroll_alpha = scroll_img.split()[3]
-        scroll_alpha = scroll_alpha.point(lambda pixel: pixel * 0.33)
-        scroll_img.putalpha(scroll_alpha)
-
-        scroll_layer = Image.new("RGBA", canvas.size, (0, 0, 0, 0))
-        scroll_layer.paste(scroll_img, (self.CANVAS_WIDTH - scroll_img.width - 10, 0), scroll_img)
-        canvas = Image.alpha_composite(canvas, scroll_layer)
-
+    def generate_quote_image(self, quote: Quote, load_image: Callable[[str], bytes]) -> io.BytesIO:
+        canvas = self._background.copy()
         draw = ImageDraw.Draw(canvas)
         text = self.quote_text_generator.generate_quote(quote)
 
@@ -235,8 +332,7 @@ class QuoteImageGenerator:
             start_size=60,
         )
 
-        bbox = draw.textbbox((0, 0), "A", font=font)
-        line_height = bbox[3] - bbox[1]
+        line_height = self._line_height(draw, font)
         total_height = int(line_height * len(wrapped_lines) * 1.2)
         y_offset = text_y + (text_box_height - total_height) // 2
 
@@ -274,25 +370,19 @@ class QuoteImageGenerator:
         date_width, date_height = draw.textbbox((0, 0), date_text, font=secondary_font)[2:]
         draw.text((self.CANVAS_WIDTH - date_width - 40, self.CANVAS_HEIGHT - date_height - 10), date_text, font=secondary_font, fill=(255, 255, 255, 255))
 
-        quote_layer = Image.new("RGBA", canvas.size, (0, 0, 0, 0))
-        quote_layer.paste(
+        self._alpha_composite_at(
+            canvas,
             self._quote_sign_img,
             (first_line_x - self._quote_sign_img.width, first_line_y - self._quote_sign_img.height // 3),
-            self._quote_sign_img,
         )
-        canvas = Image.alpha_composite(canvas, quote_layer)
 
-        if images:
-            main_image = None
-            main_image_id = self._get_main_speaker_image_id(quote, main_speaker)
-            if main_image_id:
-                main_image = images.get(main_image_id)
-            if main_image is None:
-                main_image = next(iter(images.values()))
-            canvas = self.add_main_sticker_to_canvas(main_image, self.CANVAS_HEIGHT, canvas)
+        # Only the main sticker is drawn, so only its bytes are requested.
+        main_image_id = self._get_main_speaker_image_id(quote, main_speaker) or self._get_first_image_id(quote)
+        if main_image_id:
+            canvas = self.add_main_sticker_to_canvas(load_image(main_image_id), self.CANVAS_HEIGHT, canvas)
 
         output = io.BytesIO()
         output.name = "sticker_with_text.png"
-        canvas.save(output, format="PNG")
+        canvas.save(output, format="PNG", compress_level=self.PNG_COMPRESS_LEVEL)
         output.seek(0)
         return output
@@ -3,6 +3,9 @@
 from date_parser.date_parser import DateParser
 from domain.quote import Quote
 
+WHITESPACE_RE = re.compile(r"\s+")
+NON_WORD_RE = re.compile(r"[^\w]")
+
 
 class QuoteTextGenerator:
     def __init__(self, date_parser: DateParser):
@@ -10,27 +13,20 @@ class QuoteTextGenerator:
 
     def get_unique_names(self, quote: Quote) -> list[str]:
         """Collect unique speaker names in quote order."""
-        seen: set[str] = set()
-        unique: list[str] = []
+        unique: dict[str, str] = {}
         for phrase in quote.phrases:
-            if not phrase.speaker:
-                continue
-            name = phrase.speaker.name
-            key = name.casefold()
-            if key in seen:
-                continue
-            seen.add(key)
-            unique.append(name)
-        return unique
+            if phrase.speaker:
+                unique.setdefault(phrase.speaker.name.casefold(), phrase.speaker.name)
+        return list(unique.values())
 
     def _name_to_hashtag(self, name: str) -> str:
-        normalized = re.sub(r"\s+", "_", name.strip())
-        normalized = re.sub(r"[^\w]", "", normalized, flags=re.UNICODE)
+        normalized = WHITESPACE_RE.sub("_", name.strip())
+        normalized = NON_WORD_RE.sub("", normalized)
         return f"#{normalized}" if normalized else ""
 
     def generate_tags(self, quote: Quote) -> str:
         """Generate hashtags for all speakers in a quote."""
-        tags = [self._name_to_hashtag(name) for name in self.get_unique_names(quote)]
+        tags = (self._name_to_hashtag(name) for name in self.get_unique_names(quote))
         return " ".join(tag for tag in tags if tag)
 
     def generate_quote(self, quote: Quote) -> str:
@@ -1,7 +1,14 @@
-﻿import io
+﻿import atexit
+import io
 import os
+import signal
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
 
+import requests
 import telebot
 from dotenv import load_dotenv
 from telebot import custom_filters, types
@@ -43,19 +50,38 @@ if STATE_STORAGE_TYPE == "pickle":
     storage = StatePickleStorage(file_path=state_file_path)
 else:
     storage = StateMemoryStorage()
-bot = telebot.TeleBot(BOT_TOKEN, state_storage=storage, use_class_middlewares=True)
+# Handlers block on Telegram round-trips, so more workers let other users proceed meanwhile.
+BOT_NUM_THREADS = int(os.getenv("BOT_NUM_THREADS", "4"))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "50"))
+# Public base URL for webhook mode; long polling is used when it is not set.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# The only update types the handlers below consume.
+ALLOWED_UPDATES = ["message", "callback_query"]
+bot = telebot.TeleBot(BOT_TOKEN, state_storage=storage, use_class_middlewares=True, num_threads=BOT_NUM_THREADS)
 bot.add_custom_filter(custom_filters.StateFilter(bot))
 bot.setup_middleware(StateMiddleware(bot))
 
 speaker_repository: SpeakerRepository = JsonSpeakerRepository("speakers.json")
+atexit.register(speaker_repository.flush)
 target_repository: TargetRepository = JsonTargetRepository("targets.json")
 
 date_parser = DateParser()
 quote_text_generator = QuoteTextGenerator(date_parser)
 quote_image_generator = QuoteImageGenerator(quote_text_generator, date_parser)
 
-# Cache downloaded sticker bytes by Telegram file_id.
-sticker_file_cache: dict[str, bytes] = {}
+# Cache downloaded sticker bytes by Telegram file_id, least recently used first.
+STICKER_FILE_CACHE_SIZE = 512
+sticker_file_cache: OrderedDict[str, bytes] = OrderedDict()
+sticker_file_cache_lock = threading.Lock()
+
+# Speaker name keyboards per speaker scope, with the names they were built from.
+MAX_SPEAKER_KEYBOARD_BUTTONS = 30
+speaker_keyboard_cache: dict[int | str, tuple[tuple[str, ...], types.ReplyKeyboardMarkup]] = {}
+
+# Telegram rejects photo captions longer than this.
+PHOTO_CAPTION_LIMIT = 1024
 
 
 def parse_chat_id(value: str) -> int | str:
@@ -97,6 +123,7 @@ class SpeakerEditState(StatesGroup):
 
 
 # ------------------ Callback data ------------------
+# Cancel/none values reuse their selection prefix, so a prefix filter alone routes them too.
 
 QUOTE_TARGET_PREFIX = "quote:target:"
 QUOTE_TARGET_CANCEL = "quote:target:cancel"
@@ -129,6 +156,13 @@ EDIT_SELECT_CANCEL = "edit_speaker:select:cancel"
 EDIT_SET_PRIMARY_PREFIX = "edit_speaker:set_primary:"
 EDIT_REMOVE_IMAGE_PREFIX = "edit_speaker:remove_image:"
 
+# Callback data accepted by the fixed-choice callback handlers.
+ADD_SPEAKER_IMAGE_CALLBACKS = frozenset((ADD_SPEAKER_IMAGE_YES, ADD_SPEAKER_IMAGE_NO, ADD_SPEAKER_IMAGE_CANCEL))
+ADD_CONTEXT_CALLBACKS = frozenset((ADD_CONTEXT_YES, ADD_CONTEXT_NO))
+EDIT_ACTION_CALLBACKS = frozenset(
+    (EDIT_ACTION_RENAME, EDIT_ACTION_ADD_IMAGE, EDIT_ACTION_SET_PRIMARY, EDIT_ACTION_REMOVE_IMAGE, EDIT_ACTION_DONE)
+)
+
 ADD_GROUP_TARGET_REQUEST_ID = 1001
 ADD_CHANNEL_TARGET_REQUEST_ID = 1002
 
@@ -136,9 +170,8 @@ ADD_CHANNEL_TARGET_REQUEST_ID = 1002
 # ------------------ Utils ------------------
 
 def clear_session(user_id: int, chat_id: int) -> None:
+    # delete_state() drops the whole record, data included.
     bot.delete_state(user_id, chat_id)
-    with bot.retrieve_data(user_id, chat_id) as data:
-        data.clear()
 
 
 def get_quote_from_state(user_id: int, chat_id: int) -> Quote | None:
@@ -284,17 +317,12 @@ def get_or_create_speaker(name: str, chat_id: int | str) -> Speaker:
 
 
 def get_unique_speakers_from_quote(quote: Quote) -> list[Speaker]:
-    seen: set[str] = set()
-    unique: list[Speaker] = []
+    # Dicts keep insertion order, so setdefault de-duplicates case-insensitively in quote order.
+    unique: dict[str, Speaker] = {}
     for phrase in quote.phrases:
-        if not phrase.speaker:
-            continue
-        key = phrase.speaker.name.casefold()
-        if key in seen:
-            continue
-        seen.add(key)
-        unique.append(phrase.speaker)
-    return unique
+        if phrase.speaker:
+            unique.setdefault(phrase.speaker.name.casefold(), phrase.speaker)
+    return list(unique.values())
 
 
 def ensure_main_speaker_name(quote: Quote) -> None:
@@ -334,29 +362,46 @@ def bytes_to_image_io(image_bytes: bytes, name: str = "quote.png") -> io.BytesIO
     return output
 
 
-def download_sticker_images_for_quote(quote: Quote) -> dict[str, bytes]:
-    indexed_images: dict[str, bytes] = {}
-    for phrase in quote.phrases:
-        if not phrase.speaker:
-            continue
+def get_cached_sticker_file(file_id: str) -> bytes | None:
+    with sticker_file_cache_lock:
+        image = sticker_file_cache.get(file_id)
+        if image is not None:
+            sticker_file_cache.move_to_end(file_id)
+        return image
 
-        file_id = phrase.speaker_image_id or phrase.speaker.speaker_image_id
-        if not file_id:
-            continue
 
-        if file_id in indexed_images:
-            continue
+def cache_sticker_file(file_id: str, image: bytes) -> None:
+    with sticker_file_cache_lock:
+        sticker_file_cache[file_id] = image
+        sticker_file_cache.move_to_end(file_id)
+        while len(sticker_file_cache) > STICKER_FILE_CACHE_SIZE:
+            sticker_file_cache.popitem(last=False)
 
-        if file_id in sticker_file_cache:
-            indexed_images[file_id] = sticker_file_cache[file_id]
-            continue
 
+def forget_sticker_file(file_id: str) -> None:
+    with sticker_file_cache_lock:
+        sticker_file_cache.pop(file_id, None)
+
+
+def download_sticker_file(file_id: str) -> bytes:
+    try:
         file_info = bot.get_file(file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        sticker_file_cache[file_id] = downloaded_file
-        indexed_images[file_id] = downloaded_file
+    except ApiTelegramException as error:
+        if error.error_code != 429:
+            raise
+        # Rate limited: wait as long as Telegram asks, then retry once.
+        retry_after = error.result_json.get("parameters", {}).get("retry_after", 1)
+        time.sleep(retry_after)
+        file_info = bot.get_file(file_id)
+    return bot.download_file(file_info.file_path)
+
 
-    return indexed_images
+def load_sticker_file(file_id: str) -> bytes:
+    image = get_cached_sticker_file(file_id)
+    if image is None:
+        image = download_sticker_file(file_id)
+        cache_sticker_file(file_id, image)
+    return image
 
 
 def get_quote_text_and_image(quote: Quote, user_id: int, chat_id: int) -> tuple[str, io.BytesIO]:
@@ -369,24 +414,25 @@ def get_quote_text_and_image(quote: Quote, user_id: int, chat_id: int) -> tuple[
         if cached_signature == signature and cached_text and cached_image:
             return cached_text, bytes_to_image_io(cached_image)
 
-    indexed_images = download_sticker_images_for_quote(quote)
-    image = quote_image_generator.generate_quote_image(quote, indexed_images)
+    image = quote_image_generator.generate_quote_image(quote, load_sticker_file)
     quote_text = quote_text_generator.generate_quote_with_tags(quote)
 
     image_bytes = image.getvalue()
-    bot.add_data(
-        user_id,
-        chat_id,
-        rendered_signature=signature,
-        rendered_quote_text=quote_text,
-        rendered_image_bytes=image_bytes,
-    )
+    # One state round-trip for all three keys; add_data() would save once per key.
+    with bot.retrieve_data(user_id, chat_id) as data:
+        data["rendered_signature"] = signature
+        data["rendered_quote_text"] = quote_text
+        data["rendered_image_bytes"] = image_bytes
 
-    return quote_text, bytes_to_image_io(image_bytes)
+    # The generator already returns an encoded, rewound PNG; hand it over as is.
+    image.name = "quote.png"
+    return quote_text, image
 
 
-def reset_render_cache(user_id: int, chat_id: int) -> None:
+def update_quote_in_state(user_id: int, chat_id: int, quote: Quote) -> None:
+    # Store an edited quote and drop its now stale render in a single state write.
     with bot.retrieve_data(user_id, chat_id) as data:
+        data["quote"] = quote
         data.pop("rendered_signature", None)
         data.pop("rendered_quote_text", None)
         data.pop("rendered_image_bytes", None)
@@ -417,6 +463,8 @@ def ensure_quote_exists(message: types.Message) -> Quote | None:
     return ensure_quote_exists_for_session(message.from_user.id, message.chat.id)
 
 
+# Argument-free keyboards are constant and only ever serialised, so each is built once and reused.
+@lru_cache(maxsize=None)
 def build_date_keyboard() -> types.InlineKeyboardMarkup:
     keyboard = types.InlineKeyboardMarkup()
     keyboard.add(types.InlineKeyboardButton("📅 Today", callback_data=DATE_TODAY))
@@ -445,6 +493,7 @@ def build_target_settings_keyboard(target: QuoteTarget) -> types.InlineKeyboardM
     return keyboard
 
 
+@lru_cache(maxsize=None)
 def build_add_target_keyboard() -> types.ReplyKeyboardMarkup:
     group_admin_rights = types.ChatAdministratorRights(
         is_anonymous=False,
@@ -510,6 +559,23 @@ def build_add_target_keyboard() -> types.ReplyKeyboardMarkup:
     return keyboard
 
 
+def build_speaker_names_keyboard(speaker_scope_chat_id: int | str) -> types.ReplyKeyboardMarkup | None:
+    speakers = speaker_repository.get_speakers(chat_id=speaker_scope_chat_id)
+    names = tuple(speaker.name for speaker in speakers[:MAX_SPEAKER_KEYBOARD_BUTTONS])
+    if not names:
+        return None
+
+    cached = speaker_keyboard_cache.get(speaker_scope_chat_id)
+    if cached is not None and cached[0] == names:
+        return cached[1]
+
+    keyboard = types.ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
+    for name in names:
+        keyboard.add(types.KeyboardButton(name))
+    speaker_keyboard_cache[speaker_scope_chat_id] = (names, keyboard)
+    return keyboard
+
+
 def build_phrase_image_keyboard(speaker: Speaker) -> types.InlineKeyboardMarkup:
     keyboard = types.InlineKeyboardMarkup(row_width=2)
     for index, _ in enumerate(speaker.speaker_image_ids):
@@ -518,6 +584,7 @@ def build_phrase_image_keyboard(speaker: Speaker) -> types.InlineKeyboardMarkup:
     return keyboard
 
 
+@lru_cache(maxsize=None)
 def build_add_speaker_image_keyboard() -> types.InlineKeyboardMarkup:
     keyboard = types.InlineKeyboardMarkup(row_width=2)
     keyboard.add(
@@ -528,6 +595,7 @@ def build_add_speaker_image_keyboard() -> types.InlineKeyboardMarkup:
     return keyboard
 
 
+@lru_cache(maxsize=None)
 def build_add_context_keyboard() -> types.InlineKeyboardMarkup:
     keyboard = types.InlineKeyboardMarkup(row_width=2)
     keyboard.add(
@@ -592,6 +660,7 @@ def build_main_speaker_keyboard(quote: Quote) -> types.InlineKeyboardMarkup:
     return keyboard
 
 
+@lru_cache(maxsize=None)
 def build_next_step_keyboard() -> types.InlineKeyboardMarkup:
     keyboard = types.InlineKeyboardMarkup(row_width=2)
     keyboard.add(
@@ -640,15 +709,13 @@ def prompt_phrase_image_for_last_phrase(user_id: int, chat_id: int) -> None:
 
     if not speaker.speaker_image_ids:
         phrase.speaker_image_id = None
-        set_quote_to_state(user_id, chat_id, quote)
-        reset_render_cache(user_id, chat_id)
+        update_quote_in_state(user_id, chat_id, quote)
         prompt_add_speaker_image_for_last_phrase(user_id, chat_id, speaker)
         return
 
     if phrase.speaker_image_id not in speaker.speaker_image_ids:
         phrase.speaker_image_id = speaker.speaker_image_ids[0]
-        set_quote_to_state(user_id, chat_id, quote)
-        reset_render_cache(user_id, chat_id)
+        update_quote_in_state(user_id, chat_id, quote)
 
     bot.set_state(user_id, QuoteState.waiting_for_phrase_image_selection, chat_id)
     safe_send_message(
@@ -768,19 +835,25 @@ def process_speaker_name_end(user_id: int, chat_id: int) -> None:
         safe_send_message(chat_id, "Failed to build preview due to image rendering error.")
         return
 
-    safe_send_message(chat_id, f"Did {name} really say that? Your quote preview:")
-    safe_send_photo(chat_id, photo=image, caption=quote_text)
-    safe_send_message(
-        chat_id,
-        "Do you want to add a new phrase or finalize the quote?",
-        reply_markup=build_next_step_keyboard(),
-    )
+    # Header, preview and next-step buttons go out as one photo message when the caption allows.
+    header = f"Did {name} really say that? Your quote preview:"
+    caption = f"{header}\n\n{quote_text}"
+    if len(caption) > PHOTO_CAPTION_LIMIT:
+        safe_send_message(chat_id, header)
+        caption = quote_text
+
+    if safe_send_photo(chat_id, photo=image, caption=caption, reply_markup=build_next_step_keyboard()) is None:
+        safe_send_message(
+            chat_id,
+            "Do you want to add a new phrase or finalize the quote?",
+            reply_markup=build_next_step_keyboard(),
+        )
 
 
 def prompt_quote_date(user_id: int, chat_id: int, target: QuoteTarget) -> None:
-    safe_send_message(chat_id, f"Creating quote for {target_label(target)}.")
     safe_send_message(
         chat_id,
+        f"Creating quote for {target_label(target)}.\n"
         "When did you hear these words? Send date as dd.mm.yyyy or use the button.",
         reply_markup=build_date_keyboard(),
     )
@@ -837,7 +910,7 @@ def create_quote(message: types.Message):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith(QUOTE_TARGET_PREFIX) or call.data == QUOTE_TARGET_CANCEL)
+@bot.callback_query_handler(func=lambda call: call.data.startswith(QUOTE_TARGET_PREFIX))
 def process_quote_target_selection(call: types.CallbackQuery):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
@@ -1040,9 +1113,8 @@ def process_today_callback(call: types.CallbackQuery):
 
 @bot.message_handler(state=QuoteState.waiting_for_date, content_types=["text"])
 def process_quote_date(message: types.Message):
-    try:
-        date = date_parser.parse_string_to_date(message.text)
-    except ValueError:
+    date = date_parser.try_parse_string_to_date(message.text)
+    if date is None:
         safe_send_message(message.chat.id, "Invalid date. Example: 25.06.2005")
         bot.set_state(message.from_user.id, QuoteState.waiting_for_date, message.chat.id)
         return
@@ -1069,32 +1141,29 @@ def process_phrase_text(message: types.Message):
         safe_send_message(message.chat.id, "Phrase text cannot be empty.")
         return
 
-    quote.phrases.append(Phrase(speaker=None, text=text))
-    set_quote_to_state(message.from_user.id, message.chat.id, quote)
-    reset_render_cache(message.from_user.id, message.chat.id)
-
+    # Resolve a replied-to speaker before storing, so the new phrase is written to state once.
+    speaker = None
     if message.reply_to_message and message.reply_to_message.from_user:
         speaker_name = get_speaker_display_name_from_user(message.reply_to_message.from_user)
         speaker = get_or_create_speaker(speaker_name, chat_id=speaker_scope_chat_id)
-        quote.phrases[-1].speaker = speaker
+
+    quote.phrases.append(Phrase(speaker=speaker, text=text))
+    if speaker is not None:
         ensure_main_speaker_name(quote)
-        set_quote_to_state(message.from_user.id, message.chat.id, quote)
+    update_quote_in_state(message.from_user.id, message.chat.id, quote)
 
+    if speaker is not None:
         safe_send_message(message.chat.id, f"Using replied user as speaker: {speaker.name}")
         continue_after_speaker_set(message)
         return
 
     bot.set_state(message.from_user.id, SpeakerState.waiting_for_name, message.chat.id)
 
-    speakers = [speaker.name for speaker in speaker_repository.get_speakers(chat_id=speaker_scope_chat_id)]
-    keyboard = types.ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-    for name in speakers[:30]:
-        keyboard.add(types.KeyboardButton(name))
-
+    keyboard = build_speaker_names_keyboard(speaker_scope_chat_id)
     safe_send_message(
         message.chat.id,
         f'"{text}"\nWho said this?',
-        reply_markup=keyboard if speakers else types.ReplyKeyboardRemove(),
+        reply_markup=keyboard or types.ReplyKeyboardRemove(),
     )
 
 
@@ -1118,8 +1187,7 @@ def process_speaker_name(message: types.Message):
     speaker = get_or_create_speaker(name, chat_id=speaker_scope_chat_id)
     quote.phrases[-1].speaker = speaker
     ensure_main_speaker_name(quote)
-    set_quote_to_state(message.from_user.id, message.chat.id, quote)
-    reset_render_cache(message.from_user.id, message.chat.id)
+    update_quote_in_state(message.from_user.id, message.chat.id, quote)
 
     safe_send_message(message.chat.id, "Speaker saved.", reply_markup=types.ReplyKeyboardRemove())
     continue_after_speaker_set(message)
@@ -1141,7 +1209,7 @@ def process_edit_speaker_command(message: types.Message):
     prompt_edit_target_selection(message.from_user.id, message.chat.id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith(EDIT_TARGET_PREFIX) or call.data == EDIT_TARGET_CANCEL)
+@bot.callback_query_handler(func=lambda call: call.data.startswith(EDIT_TARGET_PREFIX))
 def process_edit_target_selection(call: types.CallbackQuery):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
@@ -1260,7 +1328,7 @@ def process_edit_speaker_selection(call: types.CallbackQuery):
     prompt_edit_speaker_actions(user_id, chat_id, speakers[selected_index])
 
 
-@bot.callback_query_handler(func=lambda call: call.data in (EDIT_ACTION_RENAME, EDIT_ACTION_ADD_IMAGE, EDIT_ACTION_SET_PRIMARY, EDIT_ACTION_REMOVE_IMAGE, EDIT_ACTION_DONE))
+@bot.callback_query_handler(func=lambda call: call.data in EDIT_ACTION_CALLBACKS)
 def process_edit_speaker_action(call: types.CallbackQuery):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
@@ -1465,12 +1533,12 @@ def process_edit_speaker_remove_image(call: types.CallbackQuery):
         return
     speaker_repository.save_speaker(speaker, chat_id=target_chat_id)
     # Best-effort local cache cleanup.
-    sticker_file_cache.pop(removed_image, None)
+    forget_sticker_file(removed_image)
     safe_send_message(chat_id, f"Image removed from '{speaker.name}'.")
     prompt_edit_speaker_actions(user_id, chat_id, speaker)
 
 
-@bot.callback_query_handler(func=lambda call: call.data in (ADD_SPEAKER_IMAGE_YES, ADD_SPEAKER_IMAGE_NO, ADD_SPEAKER_IMAGE_CANCEL))
+@bot.callback_query_handler(func=lambda call: call.data in ADD_SPEAKER_IMAGE_CALLBACKS)
 def process_add_speaker_image_decision(call: types.CallbackQuery):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
@@ -1497,8 +1565,7 @@ def process_add_speaker_image_decision(call: types.CallbackQuery):
 
     if call.data == ADD_SPEAKER_IMAGE_NO:
         phrase.speaker_image_id = None
-        set_quote_to_state(user_id, chat_id, quote)
-        reset_render_cache(user_id, chat_id)
+        update_quote_in_state(user_id, chat_id, quote)
         prompt_context_for_last_phrase(user_id, chat_id)
         return
 
@@ -1535,8 +1602,7 @@ def process_add_speaker_image_sticker(message: types.Message):
     speaker.add_image_id(image_id)
     speaker_repository.save_speaker(speaker, chat_id=get_quote_speaker_scope_chat_id(user_id, chat_id))
     phrase.speaker_image_id = image_id
-    set_quote_to_state(user_id, chat_id, quote)
-    reset_render_cache(user_id, chat_id)
+    update_quote_in_state(user_id, chat_id, quote)
 
     safe_send_message(chat_id, f"Image added to '{speaker.name}'.")
     prompt_context_for_last_phrase(user_id, chat_id)
@@ -1547,7 +1613,7 @@ def process_add_speaker_image_sticker_non_sticker(message: types.Message):
     safe_send_message(message.chat.id, "Send a sticker to use as speaker image.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith(PHRASE_IMAGE_PREFIX) or call.data == PHRASE_IMAGE_NONE)
+@bot.callback_query_handler(func=lambda call: call.data.startswith(PHRASE_IMAGE_PREFIX))
 def process_phrase_image_selection(call: types.CallbackQuery):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
@@ -1584,8 +1650,7 @@ def process_phrase_image_selection(call: types.CallbackQuery):
 
         phrase.speaker_image_id = speaker.speaker_image_ids[selected_index]
 
-    set_quote_to_state(user_id, chat_id, quote)
-    reset_render_cache(user_id, chat_id)
+    update_quote_in_state(user_id, chat_id, quote)
     prompt_context_for_last_phrase(user_id, chat_id)
 
 
@@ -1601,7 +1666,7 @@ def process_phrase_image_text_fallback(message: types.Message):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data in (ADD_CONTEXT_YES, ADD_CONTEXT_NO))
+@bot.callback_query_handler(func=lambda call: call.data in ADD_CONTEXT_CALLBACKS)
 def process_add_context_callback(call: types.CallbackQuery):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
@@ -1639,8 +1704,7 @@ def process_phrase_context_text(message: types.Message):
         return
 
     quote.phrases[-1].context_text = context_text
-    set_quote_to_state(message.from_user.id, message.chat.id, quote)
-    reset_render_cache(message.from_user.id, message.chat.id)
+    update_quote_in_state(message.from_user.id, message.chat.id, quote)
 
     bot.set_state(message.from_user.id, QuoteState.waiting_for_next_step, message.chat.id)
     process_speaker_name_end(message.from_user.id, message.chat.id)
@@ -1696,8 +1760,7 @@ def process_main_speaker_selection(call: types.CallbackQuery):
     selected_name = unique_speakers[selected_index].name
     if quote.main_speaker_name != selected_name:
         quote.main_speaker_name = selected_name
-        set_quote_to_state(user_id, chat_id, quote)
-        reset_render_cache(user_id, chat_id)
+        update_quote_in_state(user_id, chat_id, quote)
 
     safe_send_message(chat_id, f"Main speaker set to: {selected_name}")
     process_speaker_name_end(user_id, chat_id)
@@ -1716,54 +1779,59 @@ def process_main_speaker_text_fallback(message: types.Message):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data in (NEXT_ADD, NEXT_MAIN, NEXT_FINALIZE, NEXT_CANCEL))
-def process_next_step_callback(call: types.CallbackQuery):
-    user_id = call.from_user.id
-    chat_id = call.message.chat.id
-    state = bot.get_state(user_id, chat_id)
+def next_step_main_speaker(user_id: int, chat_id: int) -> None:
+    quote = ensure_quote_exists_for_session(user_id, chat_id)
+    if quote is None:
+        return
 
-    if state != QuoteState.waiting_for_next_step.name:
-        bot.answer_callback_query(call.id)
+    previous_main = quote.main_speaker_name
+    ensure_main_speaker_name(quote)
+    if quote.main_speaker_name != previous_main:
+        update_quote_in_state(user_id, chat_id, quote)
+
+    unique_speakers = get_unique_speakers_from_quote(quote)
+    if not unique_speakers:
+        safe_send_message(chat_id, "No speakers available. Add at least one phrase with speaker.")
         return
 
-    bot.answer_callback_query(call.id)
+    if len(unique_speakers) == 1:
+        safe_send_message(chat_id, f"Only one speaker in quote: {unique_speakers[0].name}")
+        process_speaker_name_end(user_id, chat_id)
+        return
 
-    if call.data == NEXT_MAIN:
-        quote = ensure_quote_exists_for_session(user_id, chat_id)
-        if quote is None:
-            return
+    bot.set_state(user_id, QuoteState.waiting_for_main_speaker, chat_id)
+    safe_send_message(chat_id, "Choose the main speaker:", reply_markup=build_main_speaker_keyboard(quote))
 
-        previous_main = quote.main_speaker_name
-        ensure_main_speaker_name(quote)
-        if quote.main_speaker_name != previous_main:
-            set_quote_to_state(user_id, chat_id, quote)
-            reset_render_cache(user_id, chat_id)
 
-        unique_speakers = get_unique_speakers_from_quote(quote)
-        if not unique_speakers:
-            safe_send_message(chat_id, "No speakers available. Add at least one phrase with speaker.")
-            return
+def next_step_add_phrase(user_id: int, chat_id: int) -> None:
+    bot.set_state(user_id, PhraseState.waiting_for_text, chat_id)
+    safe_send_message(chat_id, "Send the next phrase text.")
 
-        if len(unique_speakers) == 1:
-            safe_send_message(chat_id, f"Only one speaker in quote: {unique_speakers[0].name}")
-            process_speaker_name_end(user_id, chat_id)
-            return
 
-        bot.set_state(user_id, QuoteState.waiting_for_main_speaker, chat_id)
-        safe_send_message(chat_id, "Choose the main speaker:", reply_markup=build_main_speaker_keyboard(quote))
-        return
+def next_step_cancel(user_id: int, chat_id: int) -> None:
+    clear_session(user_id, chat_id)
+    safe_send_message(chat_id, "Cancelled.", reply_markup=types.ReplyKeyboardRemove())
 
-    if call.data == NEXT_ADD:
-        bot.set_state(user_id, PhraseState.waiting_for_text, chat_id)
-        safe_send_message(chat_id, "Send the next phrase text.")
-        return
 
-    if call.data == NEXT_CANCEL:
-        clear_session(user_id, chat_id)
-        safe_send_message(chat_id, "Cancelled.", reply_markup=types.ReplyKeyboardRemove())
+NEXT_STEP_ACTIONS = {
+    NEXT_MAIN: next_step_main_speaker,
+    NEXT_ADD: next_step_add_phrase,
+    NEXT_FINALIZE: finalize_quote,
+    NEXT_CANCEL: next_step_cancel,
+}
+
+
+@bot.callback_query_handler(func=lambda call: call.data in NEXT_STEP_ACTIONS)
+def process_next_step_callback(call: types.CallbackQuery):
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    state = bot.get_state(user_id, chat_id)
+
+    bot.answer_callback_query(call.id)
+    if state != QuoteState.waiting_for_next_step.name:
         return
 
-    finalize_quote(user_id=user_id, chat_id=chat_id)
+    NEXT_STEP_ACTIONS[call.data](user_id, chat_id)
 
 
 @bot.message_handler(state=QuoteState.waiting_for_next_step)
@@ -1811,8 +1879,7 @@ def process_remove_last(message: types.Message):
 
     removed = quote.phrases.pop()
     ensure_main_speaker_name(quote)
-    set_quote_to_state(message.from_user.id, message.chat.id, quote)
-    reset_render_cache(message.from_user.id, message.chat.id)
+    update_quote_in_state(message.from_user.id, message.chat.id, quote)
 
     safe_send_message(message.chat.id, f"Removed: {removed.text}")
 
@@ -1838,8 +1905,7 @@ def process_edit_last(message: types.Message):
     command_parts = message.text.split(maxsplit=1)
     if len(command_parts) == 2 and command_parts[1].strip():
         quote.phrases[-1].text = command_parts[1].strip()
-        set_quote_to_state(message.from_user.id, message.chat.id, quote)
-        reset_render_cache(message.from_user.id, message.chat.id)
+        update_quote_in_state(message.from_user.id, message.chat.id, quote)
         bot.set_state(message.from_user.id, QuoteState.waiting_for_next_step, message.chat.id)
         safe_send_message(message.chat.id, "Last phrase updated.")
         process_speaker_name_end(message.from_user.id, message.chat.id)
@@ -1866,8 +1932,7 @@ def process_edit_last_text(message: types.Message):
         return
 
     quote.phrases[-1].text = new_text
-    set_quote_to_state(message.from_user.id, message.chat.id, quote)
-    reset_render_cache(message.from_user.id, message.chat.id)
+    update_quote_in_state(message.from_user.id, message.chat.id, quote)
     bot.set_state(message.from_user.id, QuoteState.waiting_for_next_step, message.chat.id)
     process_speaker_name_end(message.from_user.id, message.chat.id)
 
@@ -1885,4 +1950,36 @@ def process_cancel(message: types.Message):
 
 # ------------------ Run ------------------
 
-bot.infinity_polling(skip_pending=True)
+def handle_sigterm(signum, frame) -> None:
+    # The default SIGTERM action (docker stop, systemctl stop) skips atexit and would drop
+    # speaker changes still waiting for the flush timer, so exit through SystemExit instead.
+    bot.stop_polling()
+    raise SystemExit(0)
+
+
+signal.signal(signal.SIGTERM, handle_sigterm)
+
+if WEBHOOK_URL:
+    # Telegram pushes updates to us, so no getUpdates round-trips at all; needs fastapi and uvicorn.
+    bot.run_webhooks(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path="webhook/",
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/webhook/",
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=True,
+    )
+else:
+    # getUpdates is refused while a webhook from an earlier webhook-mode run is still registered.
+    # A failure here must not keep the bot from starting; infinity_polling retries on its own.
+    try:
+        bot.remove_webhook()
+    except (ApiTelegramException, requests.RequestException) as error:
+        telebot.logger.warning("Could not remove webhook before polling: %s", error)
+    # Long polls with only the update types the handlers use: fewer empty round-trips, nothing to drop in Python.
+    bot.infinity_polling(
+        skip_pending=True,
+        timeout=POLLING_TIMEOUT,
+        long_polling_timeout=POLLING_TIMEOUT,
+        allowed_updates=ALLOWED_UPDATES,
+    )